@@ -1,14 +1,41 @@
 import streamlit as st
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 import pandas as pd
-import plotly.express as px
+from pandas.api.types import is_numeric_dtype
+try:
+    import pydeck as pdk
+    HAVE_PYDECK = True
+except ImportError:
+    HAVE_PYDECK = False
 import numpy as np
+import math
 import time
+import re
+import shelve
+import threading
+from dataclasses import dataclass
 from streamlit.components.v1 import html # NOVO: Para injetar JavaScript
 
 # --- Bibliotecas para Geocodificação ---
 from geopy.geocoders import Nominatim
 from geopy.exc import GeocoderTimedOut, GeocoderServiceError
+from geopy.extra.rate_limiter import RateLimiter
+
+# --- Aceleração opcional do cálculo de distância (Numba) ---
+try:
+    from numba import njit, prange
+    HAVE_NUMBA = True
+except ImportError:
+    HAVE_NUMBA = False
+
+# --- Decodificador JSON mais rápido (orjson), com fallback para o json da biblioteca padrão ---
+try:
+    import orjson
+    HAVE_ORJSON = True
+except ImportError:
+    HAVE_ORJSON = False
 
 # --- CONFIGURAÇÃO DA PÁGINA ---
 st.set_page_config(
@@ -27,6 +54,36 @@ if 'location_source' not in st.session_state:
 # --- CHAVE DE COMPONENTE (MANTIDA como referência, mas removida da chamada html) ---
 GEO_KEY = "browser_geolocation_component"
 
+# --- URL DA API (resolvida uma única vez; pode ser sobrescrita em st.secrets["API_URL"]) ---
+API_URL_PADRAO = "https://dados.mobilidade.rio/gps/sppo"
+try:
+    URL_API = st.secrets.get("API_URL", API_URL_PADRAO)
+except FileNotFoundError:
+    # Sem arquivo secrets.toml: usa a URL pública padrão
+    URL_API = API_URL_PADRAO
+
+# --- TEMPO DE VIDA (s) DOS DADOS DE GPS EM CACHE ---
+DATA_TTL = 15
+
+# --- INTERVALO (s) DA ATUALIZAÇÃO AUTOMÁTICA ---
+REFRESH_INTERVAL_S = 25
+
+# --- ARQUIVO DO CACHE PERSISTENTE DE GEOCODIFICAÇÃO ---
+GEOCODE_CACHE_FILE = ".geocode_cache"
+GEOCODE_CACHE_MAX_AGE = 30 * 86400 # 30 dias
+
+# --- RAIO MÁXIMO (km) PARA O PRÉ-FILTRO POR CAIXA DELIMITADORA (a aproximação piora acima disso) ---
+BBOX_MAX_KM = 30
+
+# --- MÍNIMO DE PONTOS PARA USAR O KERNEL NUMBA (abaixo disso o custo da chamada supera o ganho) ---
+NUMBA_MIN_N = 4096
+
+# --- MÁXIMO DE ÔNIBUS LISTADOS NA TABELA (os mais próximos) ---
+TABELA_MAX_LINHAS = 200
+
+# --- COLUNAS DA API EFETIVAMENTE USADAS PELO APP ---
+COLUNAS_USADAS = ['ordem', 'linha', 'latitude', 'longitude', 'datahora', 'velocidade']
+
 
 # --- COMPONENTE DE GEOLOCALIZAÇÃO (NOVO) ---
 def get_browser_location():
@@ -93,25 +150,185 @@ def get_browser_location():
 
 # --- FUNÇÕES AUXILIARES ---
 
-def haversine_distance(lat1, lon1, lat2, lon2):
-    """Calcula a distância Haversine entre dois pares de coordenadas em km."""
-    R = 6371 # Raio da Terra em km
-    phi1, phi2 = np.radians(lat1), np.radians(lat2)
-    dphi = np.radians(lon2 - lon1) 
-    dlambda = np.radians(lat2 - lat1) 
+@st.cache_resource(show_spinner=False)
+def _haversine_kernel():
+    """
+    Compila o kernel Haversine Numba sob demanda, uma única vez por processo (e em disco, via cache=True),
+    e o aquece com uma chamada mínima. Só é usado para n >= NUMBA_MIN_N; com o pré-filtro por caixa
+    delimitadora de uma única linha isso praticamente não acontece, por isso o Numba é opcional.
+    """
+    @njit(parallel=True, fastmath=True, cache=True)
+    def kernel(user_phi, user_lam, cos_phi1, lat_arr, lon_arr, out):
+        """Kernel Haversine compilado: um único laço paralelo, sem arrays temporários."""
+        for i in prange(lat_arr.shape[0]):
+            phi2 = math.radians(lat_arr[i])
+            dphi = phi2 - user_phi
+            dlam = math.radians(lon_arr[i]) - user_lam
+            a = math.sin(dphi * 0.5) ** 2 + cos_phi1 * math.cos(phi2) * math.sin(dlam * 0.5) ** 2
+            out[i] = 2.0 * 6371.0 * math.asin(math.sqrt(a))
+
+    vazio = np.zeros(1, dtype=np.float32)
+    kernel(0.0, 0.0, 1.0, vazio, vazio, np.empty(1, dtype=np.float32))
+    return kernel
+
+
+def haversine_distance(user_phi, user_lam, cos_phi1, lat_arr, lon_arr):
+    """
+    Calcula a distância Haversine (km) entre o ponto do usuário e arrays de coordenadas.
+    user_phi/user_lam já vêm em radianos e cos_phi1 = cos(user_phi) é pré-calculado pelo chamador;
+    lat_arr/lon_arr são arrays NumPy float32 em graus.
+    Usa o kernel Numba para arrays grandes (n >= NUMBA_MIN_N) e NumPy puro nos demais casos.
+    """
+    n = lat_arr.shape[0]
+    if HAVE_NUMBA and n >= NUMBA_MIN_N:
+        out = np.empty(n, dtype=np.float32)
+        _haversine_kernel()(user_phi, user_lam, cos_phi1, lat_arr, lon_arr, out)
+        return out
+
+    R = 6371.0 # Raio da Terra em km
+    phi2 = np.radians(lat_arr, dtype=np.float32)
+    dphi = phi2 - user_phi
+    dlam = np.radians(lon_arr, dtype=np.float32) - user_lam
+
+    a = np.sin(dphi * 0.5) ** 2 + cos_phi1 * np.cos(phi2) * np.sin(dlam * 0.5) ** 2
+    return 2.0 * R * np.arcsin(np.sqrt(a))
+
+
+def haversine_km(lat_scalar, lon_scalar, lats, lons):
+    """
+    Distância Haversine (km) de um ponto fixo (graus) até arrays/Series de lat/lon (graus).
+    Radianos e cosseno do ponto fixo são calculados uma única vez; as coordenadas viram float32 uma só vez.
+    """
+    phi1 = math.radians(lat_scalar)
+    return haversine_distance(
+        phi1, math.radians(lon_scalar), math.cos(phi1),
+        np.asarray(lats, dtype=np.float32), np.asarray(lons, dtype=np.float32)
+    )
+
+
+def _to_float_series(s):
+    """
+    Converte uma coluna de coordenadas para float. Se a API já mandou números, não faz nada;
+    caso contrário troca a vírgula decimal por ponto (sem regex) e converte numa só passada.
+    """
+    if is_numeric_dtype(s):
+        return s
+    return pd.to_numeric(s.astype(str).str.replace(',', '.', regex=False), errors='coerce')
+
+
+def bbox_mask(lat0, lon0, lats, lons, r_km):
+    """
+    Caixa delimitadora (em graus) de lado 2*r_km em torno de (lat0, lon0), com 1% de folga.
+    Só faz comparações por linha, sem multiplicações nem trigonometria.
+    """
+    r = r_km * 1.01
+    dlat = r / 111.0
+    dlon = r / (111.0 * math.cos(math.radians(lat0)))
+    return (lats >= lat0 - dlat) & (lats <= lat0 + dlat) & (lons >= lon0 - dlon) & (lons <= lon0 + dlon)
+
+
+def cheap_filter_mask(lat0, lon0, lats, lons, r_km):
+    """
+    Pré-filtro rápido por aproximação equiretangular ("cheap ruler"), suficiente para raios pequenos.
+    Retorna a máscara booleana dos pontos a até r_km (com 1% de folga) de (lat0, lon0).
+    """
+    dx = (lons - lon0) * (math.cos(math.radians(lat0)) * 111.32)
+    dy = (lats - lat0) * 110.57
+    r = r_km * 1.01 # Folga para não descartar ônibus na borda; o corte exato é feito pelo Haversine
+    return dx * dx + dy * dy <= r * r
+
+
+def render_bus_map(df_mapa, tooltip_html, center_lat, center_lon, zoom, user_point, map_style):
+    """
+    Desenha os ônibus (vermelho) e, se houver, o ponto do usuário (azul) com pydeck/deck.gl.
+    Sem pydeck instalado, cai para o st.map nativo (sem tooltip nem estilo de mapa).
+    """
+    if not HAVE_PYDECK:
+        pontos = df_mapa[['latitude', 'longitude']].assign(cor='#ff0000')
+        if user_point:
+            pontos = pd.concat([pontos, pd.DataFrame(
+                {'latitude': [user_point[0]], 'longitude': [user_point[1]], 'cor': ['#0000ff']})])
+        st.map(pontos, latitude='latitude', longitude='longitude', color='cor', size=50, zoom=zoom)
+        return
+
+    layers = [
+        pdk.Layer(
+            "ScatterplotLayer",
+            id="onibus",
+            data=df_mapa,
+            get_position="[longitude, latitude]",
+            get_radius=50,
+            radius_min_pixels=6,
+            get_fill_color=[255, 0, 0],
+            pickable=True,
+        )
+    ]
+    if user_point:
+        layers.append(
+            pdk.Layer(
+                "ScatterplotLayer",
+                id="usuario",
+                data=[{"latitude": user_point[0], "longitude": user_point[1]}],
+                get_position="[longitude, latitude]",
+                get_radius=80,
+                radius_min_pixels=9,
+                get_fill_color=[0, 0, 255],
+            )
+        )
+
+    st.pydeck_chart(
+        pdk.Deck(
+            map_provider="carto",
+            map_style=map_style,
+            initial_view_state=pdk.ViewState(latitude=center_lat, longitude=center_lon, zoom=zoom),
+            layers=layers,
+            tooltip={"html": tooltip_html},
+        ),
+        width="stretch",
+    )
+
+
+@st.cache_resource
+def _http():
+    """Sessão HTTP persistente (keep-alive + gzip), compartilhada entre as execuções."""
+    s = requests.Session()
+    s.headers.update({"Accept-Encoding": "gzip", "User-Agent": "rj-bus-tracker"})
+    adapter = HTTPAdapter(pool_connections=4, pool_maxsize=8,
+                          max_retries=Retry(total=2, backoff_factor=0.3))
+    s.mount("https://", adapter)
+    return s
+
 
-    a = np.sin(dlambda / 2) ** 2 + np.cos(phi1) * np.cos(phi2) * np.sin(dphi / 2) ** 2
-    c = 2 * np.arctan2(np.sqrt(a), np.sqrt(1 - a))
-    return R * c
+@st.cache_resource
+def _http_validators():
+    """Último ETag/Last-Modified e corpo decodificado de cada URL, para requisições condicionais."""
+    return {}
 
 
-@st.cache_data(ttl=15) 
+@st.cache_data(ttl=DATA_TTL)  
 def get_data(url):
     """Busca dados da API de GPS dos ônibus (Cache de 15 segundos)."""
     try:
-        response = requests.get(url, timeout=15)
-        if response.status_code == 200:
-            return response.json()
+        # Requisição condicional: se o servidor responder 304, reaproveita o último corpo recebido
+        anterior = _http_validators().get(url)
+        headers = {}
+        if anterior:
+            etag, last_modified, _ = anterior
+            if etag:
+                headers["If-None-Match"] = etag
+            if last_modified:
+                headers["If-Modified-Since"] = last_modified
+
+        # Timeout separado: 3s para conectar, 15s para ler a resposta
+        response = _http().get(url, headers=headers, timeout=(3, 15))
+        if response.status_code == 304 and anterior:
+            return anterior[2]
+        elif response.status_code == 200:
+            data = orjson.loads(response.content) if HAVE_ORJSON else response.json()
+            etag, last_modified = response.headers.get("ETag"), response.headers.get("Last-Modified")
+            if etag or last_modified:
+                _http_validators()[url] = (etag, last_modified, data)
+            return data
         else:
             st.warning(f"Erro ao buscar dados da API. Código: {response.status_code}")
             return None
@@ -120,12 +337,45 @@ def get_data(url):
         return None
 
 
-@st.cache_data(ttl=3600) 
+@st.cache_resource
+def _geolocator():
+    """Instância única do Nominatim, reutilizada entre execuções e sessões."""
+    return Nominatim(user_agent="streamlit_rj_bus_tracker_app_1", timeout=10)
+
+
+@st.cache_resource
+def _geocode_limited():
+    """
+    Geocodificação limitada a 1 requisição por segundo (política de uso do Nominatim),
+    compartilhada entre todas as sessões. Erros são propagados para o tratamento em geocode_address.
+    Sem novas tentativas (max_retries=0): um timeout já custa os 10s do geolocator, não ~40s.
+    """
+    return RateLimiter(_geolocator().geocode, min_delay_seconds=1, max_retries=0, swallow_exceptions=False)
+
+
+@st.cache_resource
+def _geocode_store():
+    """Cache em disco (shelve) das geocodificações, compartilhado entre sessões e reinícios do app."""
+    return shelve.open(GEOCODE_CACHE_FILE), threading.Lock()
+
+
+def _normalize_address(address):
+    """
+    Normaliza o endereço para usar como chave de cache: minúsculas, espaços colapsados e sem a
+    pontuação no fim das palavras ("Av. Rio Branco, 1" -> "av rio branco 1"). Hífens dentro de
+    palavras e números (CEP "22250-040", "Rua 1-A") são mantidos.
+    """
+    chave = re.sub(r'[^\w\s]+(?=\s|$)', '', address.lower())
+    return re.sub(r'\s+', ' ', chave).strip()
+
+
 def geocode_address(address):
-    """Converte um endereço em coordenadas geográficas usando Nominatim."""
+    """
+    Converte um endereço em coordenadas (lat, lon), com cache pela forma normalizada do endereço.
+    Erros transitórios viram "TIMEOUT", "SERVICE_ERROR" ou None aqui fora do cache, para não ficarem guardados.
+    """
     try:
-        geolocator = Nominatim(user_agent="streamlit_rj_bus_tracker_app_1")
-        return geolocator.geocode(address)
+        return _geocode_cached(_normalize_address(address), address)
     except GeocoderTimedOut:
         return "TIMEOUT"
     except GeocoderServiceError:
@@ -134,283 +384,387 @@ def geocode_address(address):
         return None
 
 
+@st.cache_data(ttl=3600)
+def _geocode_cached(key, _address):
+    """
+    Consulta o cache em disco e, se necessário (ausente ou expirado), o Nominatim.
+    O cache usa só a chave normalizada (o "_" tira _address do hash); o Nominatim recebe o texto original.
+    Endereço não encontrado devolve None e fica em cache por 1h; erros do serviço são propagados
+    como exceção, que o st.cache_data não guarda. Acertos duram mais via cache em disco.
+    """
+    db, lock = _geocode_store()
+    with lock:
+        entrada = db.get(key)
+    # Entradas no formato (lat, lon, gravado_em); formatos antigos ou expiradas são refeitas
+    if entrada and len(entrada) == 3 and time.time() - entrada[2] < GEOCODE_CACHE_MAX_AGE:
+        return entrada[:2]
+
+    loc = _geocode_limited()(_address)
+    if not loc:
+        return None
+
+    # Guarda uma tupla simples (serializável) em vez do objeto Location do geopy
+    coords = (loc.latitude, loc.longitude)
+    with lock:
+        db[key] = coords + (time.time(),)
+        db.sync()
+    return coords
+
+
 # --- INTERFACE LATERAL E LÓGICA DE LOCALIZAÇÃO ---
-st.sidebar.header("🔍 Configuração de Busca")
+# Estilos de mapa base (CARTO) suportados pelo pydeck, sem necessidade de token
+MAP_STYLES = {"road": "Ruas", "light": "Claro", "dark": "Escuro"}
 
-linha_desejada = st.sidebar.text_input("Qual a linha?", value="112")
-usar_localizacao = st.sidebar.checkbox("Filtrar por localização?", value=True)
 
-# Coordenadas e raio padrão (Botafogo, RJ)
-user_lat, user_lon, raio_km = -22.9559, -43.1789, 2.0
-localizacao_sucesso = True # Estado de sucesso da localização para o filtro
+@dataclass(frozen=True)
+class Settings:
+    """Escolhas feitas na barra lateral, lidas uma vez por execução do script."""
+    linha_desejada: str
+    usar_localizacao: bool
+    raio_km: float
+    user_lat: float
+    user_lon: float
+    localizacao_sucesso: bool
+    location_source: str
+    auto_refresh: bool
+    map_style: str
 
-if usar_localizacao:
-    st.sidebar.markdown("---")
-    st.sidebar.write("📍 **Sua Localização**")
 
-    location_options = ('Localização Automática (Browser)', 'Endereço (Geocodificação)', 'Coordenadas (Lat/Lon)')
+def sidebar_controls():
+    """
+    Desenha todos os widgets da barra lateral (busca, localização, atualização e estilo do mapa)
+    e devolve as escolhas num Settings imutável.
+    """
+    st.sidebar.header("🔍 Configuração de Busca")
+
+    linha_desejada = st.sidebar.text_input("Qual a linha?", value="112")
+    usar_localizacao = st.sidebar.checkbox("Filtrar por localização?", value=True)
+
+    # Coordenadas e raio padrão (Botafogo, RJ)
+    user_lat, user_lon, raio_km = -22.9559, -43.1789, 2.0
+    localizacao_sucesso = True # Estado de sucesso da localização para o filtro
+
+    if usar_localizacao:
+        st.sidebar.markdown("---")
+        st.sidebar.write("📍 **Sua Localização**")
+
+        location_options = ('Localização Automática (Browser)', 'Endereço (Geocodificação)', 'Coordenadas (Lat/Lon)')
     
-    # Use o último valor salvo no estado ou o padrão
-    location_source = st.sidebar.radio(
-        "Como deseja informar sua localização?",
-        location_options,
-        index=location_options.index(st.session_state.location_source)
-    )
-    # Atualiza o estado da escolha do usuário
-    st.session_state.location_source = location_source
+        # Use o último valor salvo no estado ou o padrão
+        location_source = st.sidebar.radio(
+            "Como deseja informar sua localização?",
+            location_options,
+            index=location_options.index(st.session_state.location_source)
+        )
+        # Atualiza o estado da escolha do usuário
+        st.session_state.location_source = location_source
 
-    raio_km = st.sidebar.slider("Raio de busca (km)", 0.5, 20.0, 2.0)
+        raio_km = st.sidebar.slider("Raio de busca (km)", 0.5, 20.0, 2.0)
     
-    # -----------------------------------------------------------
-    # LÓGICA DE LOCALIZAÇÃO AUTOMÁTICA
-    # -----------------------------------------------------------
-    if location_source == 'Localização Automática (Browser)':
+        # -----------------------------------------------------------
+        # LÓGICA DE LOCALIZAÇÃO AUTOMÁTICA
+        # -----------------------------------------------------------
+        if location_source == 'Localização Automática (Browser)':
         
-        # CHAMA O COMPONENTE HTML/JS AQUI. 
-        geo_result = get_browser_location()
+            # CHAMA O COMPONENTE HTML/JS AQUI. 
+            geo_result = get_browser_location()
         
-        # Atualiza o session_state com o resultado
-        if isinstance(geo_result, dict) and geo_result.get('status') != 'pending':
-            st.session_state.geo_result = geo_result
-        elif geo_result is None:
-             # Se geo_result for None, o Streamlit ainda está esperando a resposta do JS. Mantemos o estado.
-             pass 
-
-        # Lógica para consumir o resultado armazenado
-        if st.session_state.geo_result['status'] == 'success':
-            user_lat = st.session_state.geo_result['latitude']
-            user_lon = st.session_state.geo_result['longitude']
-            st.sidebar.success(f"Localização Automática obtida: Lat {user_lat:.5f}, Lon {user_lon:.5f}")
-        elif st.session_state.geo_result['status'] == 'error':
-            st.sidebar.error(f"Erro ao obter localização: {st.session_state.geo_result['error']}. Tente outro método.")
-            localizacao_sucesso = False
-        else: # 'pending'
-            st.sidebar.info("Aguardando permissão do navegador para localização...")
-            localizacao_sucesso = False
+            # Atualiza o session_state com o resultado
+            if isinstance(geo_result, dict) and geo_result.get('status') != 'pending':
+                st.session_state.geo_result = geo_result
+            elif geo_result is None:
+                 # Se geo_result for None, o Streamlit ainda está esperando a resposta do JS. Mantemos o estado.
+                 pass 
+
+            # Lógica para consumir o resultado armazenado
+            if st.session_state.geo_result['status'] == 'success':
+                user_lat = st.session_state.geo_result['latitude']
+                user_lon = st.session_state.geo_result['longitude']
+                st.sidebar.success(f"Localização Automática obtida: Lat {user_lat:.5f}, Lon {user_lon:.5f}")
+            elif st.session_state.geo_result['status'] == 'error':
+                st.sidebar.error(f"Erro ao obter localização: {st.session_state.geo_result['error']}. Tente outro método.")
+                localizacao_sucesso = False
+            else: # 'pending'
+                st.sidebar.info("Aguardando permissão do navegador para localização...")
+                localizacao_sucesso = False
             
-    # -----------------------------------------------------------
-    # LÓGICA DE COORDENADAS MANUAIS
-    # -----------------------------------------------------------
-    elif location_source == 'Coordenadas (Lat/Lon)':
-        # Inputs de coordenadas existentes
-        # Limpa o resultado automático se o usuário mudar
-        st.session_state.geo_result = {'status': 'pending'} 
-
-        user_lat = st.sidebar.number_input("Sua Latitude", value=-22.9559, format="%.5f")
-        user_lon = st.sidebar.number_input("Sua Longitude", value=-43.1789, format="%.5f")
-        st.sidebar.success(f"Usando coordenadas: {user_lat:.5f}, {user_lon:.5f}")
+        # -----------------------------------------------------------
+        # LÓGICA DE COORDENADAS MANUAIS
+        # -----------------------------------------------------------
+        elif location_source == 'Coordenadas (Lat/Lon)':
+            # Inputs de coordenadas existentes
+            # Limpa o resultado automático se o usuário mudar
+            st.session_state.geo_result = {'status': 'pending'} 
+
+            user_lat = st.sidebar.number_input("Sua Latitude", value=-22.9559, format="%.5f")
+            user_lon = st.sidebar.number_input("Sua Longitude", value=-43.1789, format="%.5f")
+            st.sidebar.success(f"Usando coordenadas: {user_lat:.5f}, {user_lon:.5f}")
         
-    # -----------------------------------------------------------
-    # LÓGICA DE ENDEREÇO (GEOCODIFICAÇÃO)
-    # -----------------------------------------------------------
-    elif location_source == 'Endereço (Geocodificação)':
-        # Limpa o resultado automático se o usuário mudar
-        st.session_state.geo_result = {'status': 'pending'} 
+        # -----------------------------------------------------------
+        # LÓGICA DE ENDEREÇO (GEOCODIFICAÇÃO)
+        # -----------------------------------------------------------
+        elif location_source == 'Endereço (Geocodificação)':
+            # Limpa o resultado automático se o usuário mudar
+            st.session_state.geo_result = {'status': 'pending'} 
         
-        # Input do endereço
-        endereco_input = st.sidebar.text_input(
-            "Digite o endereço (Ex: Rua Voluntários da Pátria, 300, Rio de Janeiro)",
-            value="Av. Rio Branco, 1 - Centro, Rio de Janeiro"
-        )
-
-        if endereco_input:
-            # Chama a função de geocodificação
-            with st.spinner("Buscando coordenadas do endereço..."):
-                loc = geocode_address(endereco_input)
+            # Input do endereço
+            endereco_input = st.sidebar.text_input(
+                "Digite o endereço (Ex: Rua Voluntários da Pátria, 300, Rio de Janeiro)",
+                value="Av. Rio Branco, 1 - Centro, Rio de Janeiro"
+            )
 
-            if loc == "TIMEOUT" or loc == "SERVICE_ERROR":
-                st.sidebar.error("Erro no serviço de geocodificação. Tente outro endereço.")
-                localizacao_sucesso = False
-            elif loc:
-                # Endereço encontrado com sucesso
-                user_lat = loc.latitude
-                user_lon = loc.longitude
-                st.sidebar.success(f"Endereço encontrado: Lat {user_lat:.5f}, Lon {user_lon:.5f}")
+            if endereco_input:
+                # Chama a função de geocodificação
+                with st.spinner("Buscando coordenadas do endereço..."):
+                    loc = geocode_address(endereco_input)
+
+                if loc == "TIMEOUT" or loc == "SERVICE_ERROR":
+                    st.sidebar.error("Erro no serviço de geocodificação. Tente outro endereço.")
+                    localizacao_sucesso = False
+                elif loc:
+                    # Endereço encontrado com sucesso
+                    user_lat, user_lon = loc
+                    st.sidebar.success(f"Endereço encontrado: Lat {user_lat:.5f}, Lon {user_lon:.5f}")
+                else:
+                    # Endereço não encontrado ou genérico
+                    st.sidebar.warning("Endereço não encontrado. Tente ser mais específico.")
+                    localizacao_sucesso = False
             else:
-                # Endereço não encontrado ou genérico
-                st.sidebar.warning("Endereço não encontrado. Tente ser mais específico.")
+                st.sidebar.info("Aguardando endereço para geocodificação...")
                 localizacao_sucesso = False
-        else:
-            st.sidebar.info("Aguardando endereço para geocodificação...")
-            localizacao_sucesso = False
-
-    # Se a localização falhou (em qualquer método), volta para o padrão de Botafogo
-    if not localizacao_sucesso:
-        # Garante que, se a localização falhou ou está pendente, o filtro não será aplicado,
-        # mas as coordenadas de Botafogo serão usadas para centralizar o mapa.
-        user_lat, user_lon = -22.9559, -43.1789
-        st.sidebar.warning("Usando coordenadas padrão de fallback (Botafogo) e sem filtro de proximidade.")
-
-
-# --- CONTROLE DE ATUALIZAÇÃO AUTOMÁTICA E ESTILO DO MAPA ---
-st.sidebar.markdown("---")
-st.sidebar.write("⚙️ **Controle de Atualização**")
-auto_refresh = st.sidebar.checkbox("Atualização Automática a cada 25s", value=True) 
-
-# --- SELEÇÃO DE ESTILO DO MAPA ---
-st.sidebar.markdown("---")
-st.sidebar.write("🗺️ **Estilo do Mapa**")
-map_style = st.sidebar.selectbox(
-    "Escolha o estilo do mapa:",
-    options=["open-street-map", "stamen-terrain", "stamen-toner", "carto-positron", "carto-darkmatter"],
-    index=0, 
-    format_func=lambda x: x.replace('-', ' ').title() 
-)
-# ----------------------------------------
 
-# Botão de atualização manual 
-if st.sidebar.button("🔄 Atualizar Dados Agora"):
-    st.rerun() 
+        # Se a localização falhou (em qualquer método), volta para o padrão de Botafogo
+        if not localizacao_sucesso:
+            # Garante que, se a localização falhou ou está pendente, o filtro não será aplicado,
+            # mas as coordenadas de Botafogo serão usadas para centralizar o mapa.
+            user_lat, user_lon = -22.9559, -43.1789
+            st.sidebar.warning("Usando coordenadas padrão de fallback (Botafogo) e sem filtro de proximidade.")
 
-# --- LÓGICA PRINCIPAL ---
-st.title(f"🚌 Monitoramento: Linha {linha_desejada}")
 
-# Tenta pegar a URL do secrets ou usa a padrão
-try:
-    url_api = st.secrets["API_URL"]
-except:
-    url_api = "https://dados.mobilidade.rio/gps/sppo"
-
-# Usa st.spinner para mostrar que está buscando dados
-with st.spinner("Buscando dados em tempo real..."):
-    data = get_data(url_api)
-
-if data:
-    df_realtime = pd.DataFrame(data)
-    df_realtime.columns = df_realtime.columns.str.lower()
-
-    # 1. Filtra a linha desejada
-    df_linha = df_realtime[df_realtime['linha'].astype(str).str.contains(linha_desejada, na=False)].copy()
-
-    if not df_linha.empty:
-        # Tratamento de tipos
-        df_linha['latitude'] = df_linha['latitude'].astype(str).str.replace(',', '.')
-        df_linha['longitude'] = df_linha['longitude'].astype(str).str.replace(',', '.')
-        df_linha['latitude'] = pd.to_numeric(df_linha['latitude'], errors='coerce')
-        df_linha['longitude'] = pd.to_numeric(df_linha['longitude'], errors='coerce')
-        
-        # --- AJUSTE DE FUSO HORÁRIO (UTC-3) ---
-        df_linha['datahora_utc'] = pd.to_datetime(df_linha['datahora'], unit='ms', errors='coerce')
-        df_linha['datahora'] = df_linha['datahora_utc'] - pd.Timedelta(hours=3)
-        df_linha = df_linha.drop(columns=['datahora_utc'])
-        # -----------------------------------------------------
-
-        df_linha = df_linha.dropna(subset=['latitude', 'longitude'])
-
-        # --- DEDUPLICAÇÃO ---
-        df_linha = df_linha.sort_values(by='datahora', ascending=False)
-        df_linha = df_linha.drop_duplicates(subset=['ordem'], keep='first')
-        # -------------------
-
-        # --- FILTRO DE LOCALIZAÇÃO ---
-        # Só aplica o filtro se a caixa estiver marcada E se a localização foi bem-sucedida (localizacao_sucesso é True)
-        if usar_localizacao and localizacao_sucesso:
-            # Determina qual lógica de sucesso usar
-            is_auto_location_success = (location_source == 'Localização Automática (Browser)' and st.session_state.geo_result['status'] == 'success')
-            is_manual_location_success = (location_source != 'Localização Automática (Browser)')
-
-            if is_auto_location_success or is_manual_location_success:
-                 # Lógica para Geocodificação, Coordenadas Manuais ou Automática (se sucesso)
-                 df_linha['distancia_km'] = haversine_distance(
-                     user_lat, user_lon,
-                     df_linha['latitude'], df_linha['longitude']
-                 )
-                 df_filtrada = df_linha[df_linha['distancia_km'] <= raio_km].copy()
-                 
-                 source_text = "localização automática" if is_auto_location_success else "geocodificação/manual"
-                 msg_filtro = f"Mostrando **{len(df_filtrada)}** ônibus únicos num raio de **{raio_km}km** (via {source_text})."
-            else:
-                 # Esta parte lida com o caso de 'pending' na localização automática
-                 df_filtrada = df_linha.copy()
-                 msg_filtro = f"Mostrando todos os **{len(df_filtrada)}** ônibus da linha (Localização automática pendente)."
-        else:
-            # Mostra todos os ônibus se o filtro falhou ou não foi selecionado
-            df_filtrada = df_linha.copy()
-            msg_filtro = f"Mostrando todos os **{len(df_filtrada)}** ônibus da linha."
-            if usar_localizacao:
-                st.warning("O filtro por proximidade não foi aplicado devido à falha ou indisponibilidade da localização.")
-
-
-        # --- PLOTAGEM ---
-        if not df_filtrada.empty:
-            st.info(msg_filtro)
-
-            # Métricas
-            col1, col2 = st.columns(2)
-            col1.metric("Ônibus na região", len(df_filtrada))
-            tempo_recente = df_filtrada['datahora'].max().strftime('%H:%M:%S')
-            col2.metric("Último sinal recebido (BRT) às", tempo_recente)
-
-            # Centro do mapa
-            # Centraliza na localização do usuário/endereço se a localização foi bem-sucedida
-            location_ok = (localizacao_sucesso and usar_localizacao and 
-                           (location_source != 'Localização Automática (Browser)' or st.session_state.geo_result['status'] == 'success'))
-            
-            if location_ok:
-                center_lat, center_lon, zoom_start = user_lat, user_lon, 14
-            else:
-                # Centraliza na média dos ônibus encontrados
-                center_lat = df_filtrada['latitude'].mean()
-                center_lon = df_filtrada['longitude'].mean()
-                zoom_start = 12
-
-            fig = px.scatter_mapbox(
-                df_filtrada,
-                lat="latitude",
-                lon="longitude",
-                hover_name="ordem",
-                hover_data={"velocidade": True, "linha": True, "datahora": True,
-                             "latitude": ':.5f', "longitude": ':.5f',
-                             "distancia_km": ':.2f'} if usar_localizacao and location_ok else None,
-                zoom=zoom_start,
-                height=600,
-                center={"lat": center_lat, "lon": center_lon},
-                mapbox_style=map_style,
-                title=f"Posição atual dos ônibus da linha {linha_desejada}"
-            )
+    # --- CONTROLE DE ATUALIZAÇÃO AUTOMÁTICA E ESTILO DO MAPA ---
+    st.sidebar.markdown("---")
+    st.sidebar.write("⚙️ **Controle de Atualização**")
+    auto_refresh = st.sidebar.checkbox(f"Atualização Automática a cada {REFRESH_INTERVAL_S}s", value=True)  
 
-            fig.update_traces(marker=dict(size=18, color='red'))
+    # --- SELEÇÃO DE ESTILO DO MAPA ---
+    st.sidebar.markdown("---")
+    st.sidebar.write("🗺️ **Estilo do Mapa**")
+    map_style = st.sidebar.selectbox(
+        "Escolha o estilo do mapa:",
+        options=list(MAP_STYLES),
+        index=0, 
+        format_func=MAP_STYLES.get
+    )
+    # ----------------------------------------
+
+    # Botão de atualização manual 
+    if st.sidebar.button("🔄 Atualizar Dados Agora"):
+        st.rerun() 
+
+    return Settings(
+        linha_desejada=linha_desejada,
+        usar_localizacao=usar_localizacao,
+        raio_km=raio_km,
+        user_lat=user_lat,
+        user_lon=user_lon,
+        localizacao_sucesso=localizacao_sucesso,
+        location_source=st.session_state.location_source,
+        auto_refresh=auto_refresh,
+        map_style=map_style,
+    )
 
-            # Adiciona o usuário no mapa (Se a localização foi obtida com sucesso)
-            if location_ok:
-                fig.add_scattermapbox(
-                    lat=[user_lat], lon=[user_lon],
-                    mode='markers',
-                    marker=dict(size=25, color='blue', symbol='circle'),
-                    name='SUA LOCALIZAÇÃO'
-                )
 
-            st.plotly_chart(fig, use_container_width=True)
+cfg = sidebar_controls()
 
-            # Mostra tabela simples
-            cols_show = ['ordem', 'datahora', 'velocidade', 'latitude', 'longitude']
-            
-            df_display = df_filtrada.rename(columns={'datahora': 'Data/Hora (BRT)'})
-            cols_show[cols_show.index('datahora')] = 'Data/Hora (BRT)'
+# --- LÓGICA PRINCIPAL ---
+st.title(f"🚌 Monitoramento: Linha {cfg.linha_desejada}")
+
+# --- ATUALIZAÇÃO AUTOMÁTICA VIA FRAGMENTO ---
+# Só este bloco (busca + mapa + tabela) é reexecutado a cada 25s; a barra lateral,
+# o componente de geolocalização e a geocodificação não rodam de novo.
+@st.fragment(run_every=REFRESH_INTERVAL_S if cfg.auto_refresh else None)
+def _refresh_map(user_lat, user_lon, raio_km, linha_desejada, usar_localizacao,
+                 localizacao_sucesso, location_source, map_style):
+    """Busca os dados em tempo real e renderiza métricas, mapa e tabela da linha."""
+    # Reaproveita os registros da linha já filtrados nesta sessão enquanto estiverem dentro do TTL,
+    # sem nem consultar o cache do get_data. Só os registros da linha ficam na sessão, nunca a frota inteira.
+    agora = time.time()
+    needle = linha_desejada.strip()
+    cache_sessao = st.session_state.get('data_cache')
+    if cache_sessao and cache_sessao[1] == needle and agora - cache_sessao[0] < DATA_TTL:
+        registros, chaves = cache_sessao[2], cache_sessao[3]
+    else:
+        # Usa st.spinner para mostrar que está buscando dados
+        with st.spinner("Buscando dados em tempo real..."):
+            data = get_data(URL_API)
+        registros, chaves = None, {}
+        if data:
+            # A API pode variar a caixa dos nomes dos campos: mapeia uma vez, a partir do primeiro registro
+            chaves = {k.lower(): k for k in data[0]}
+            chave_linha = chaves.get('linha', 'linha')
+
+            # 1. Filtra a linha desejada na lista bruta (antes de qualquer DataFrame)
+            registros = [r for r in data if needle in str(r.get(chave_linha) or '')]
+            st.session_state['data_cache'] = (agora, needle, registros, chaves)
+
+    if registros is not None:
+        # Monta o DataFrame só com os registros e colunas usados
+        df_linha = pd.DataFrame(registros, columns=[chaves.get(c, c) for c in COLUNAS_USADAS])
+        df_linha.columns = COLUNAS_USADAS
+
+        if not df_linha.empty:
+            # Tratamento de tipos
+            # Identificadores repetidos viram categorias: o groupby passa a comparar códigos inteiros, não strings
+            df_linha = df_linha.astype({'ordem': 'category', 'linha': 'category'})
+            # float32 basta para coordenadas (~1 m de erro) e reduz pela metade a memória lida pelo Haversine
+            for col in ('latitude', 'longitude'):
+                df_linha[col] = _to_float_series(df_linha[col]).astype(np.float32)
+            # Velocidade chega como texto; o menor tipo inteiro possível reduz a memória do resto do pipeline
+            df_linha['velocidade'] = pd.to_numeric(df_linha['velocidade'], errors='coerce', downcast='integer')
+        
+            # --- AJUSTE DE FUSO HORÁRIO (America/Sao_Paulo) ---
+            # Converte os milissegundos UTC uma única vez; a conversão de fuso só altera metadados
+            ts_ms = pd.to_numeric(df_linha['datahora'], errors='coerce')
+            df_linha['datahora'] = pd.to_datetime(ts_ms, unit='ms', utc=True, errors='coerce').dt.tz_convert('America/Sao_Paulo')
+            # -----------------------------------------------------
+
+            df_linha = df_linha.dropna(subset=['latitude', 'longitude', 'datahora'])
+
+            # --- DEDUPLICAÇÃO ---
+            # Mantém o registro mais recente de cada ônibus sem ordenar o DataFrame inteiro
+            idx = df_linha.groupby('ordem', sort=False, observed=True)['datahora'].idxmax()
+            df_linha = df_linha.loc[idx]
+            # -------------------
+
+            # --- FILTRO DE LOCALIZAÇÃO ---
+            # Só aplica o filtro se a caixa estiver marcada E se a localização foi bem-sucedida (localizacao_sucesso é True)
+            if usar_localizacao and localizacao_sucesso:
+                # Determina qual lógica de sucesso usar
+                is_auto_location_success = (location_source == 'Localização Automática (Browser)' and st.session_state.geo_result['status'] == 'success')
+                is_manual_location_success = (location_source != 'Localização Automática (Browser)')
+
+                if is_auto_location_success or is_manual_location_success:
+                     # Lógica para Geocodificação, Coordenadas Manuais ou Automática (se sucesso)
+                     # As colunas já são float32: to_numpy devolve uma visão, sem cópia
+                     lat_arr = df_linha['latitude'].to_numpy()
+                     lon_arr = df_linha['longitude'].to_numpy()
+
+                     # Pré-filtros baratos (caixa delimitadora, depois distância plana); o Haversine só roda nos sobreviventes
+                     if raio_km <= BBOX_MAX_KM:
+                         idx = np.flatnonzero(bbox_mask(user_lat, user_lon, lat_arr, lon_arr, raio_km))
+                     else:
+                         idx = np.arange(len(lat_arr))
+                     idx = idx[cheap_filter_mask(user_lat, user_lon, lat_arr[idx], lon_arr[idx], raio_km)]
+                     dist = haversine_km(user_lat, user_lon, lat_arr[idx], lon_arr[idx])
+
+                     # Corte exato feito nos arrays NumPy; o DataFrame é fatiado uma única vez
+                     dentro = dist <= raio_km
+                     df_filtrada = df_linha.iloc[idx[dentro]].copy()
+                     df_filtrada['distancia_km'] = dist[dentro]
+                 
+                     source_text = "localização automática" if is_auto_location_success else "geocodificação/manual"
+                     msg_filtro = f"Mostrando **{len(df_filtrada)}** ônibus únicos num raio de **{raio_km}km** (via {source_text})."
+                else:
+                     # Esta parte lida com o caso de 'pending' na localização automática
+                     df_filtrada = df_linha.copy()
+                     msg_filtro = f"Mostrando todos os **{len(df_filtrada)}** ônibus da linha (Localização automática pendente)."
+            else:
+                # Mostra todos os ônibus se o filtro falhou ou não foi selecionado
+                df_filtrada = df_linha.copy()
+                msg_filtro = f"Mostrando todos os **{len(df_filtrada)}** ônibus da linha."
+                if usar_localizacao:
+                    st.warning("O filtro por proximidade não foi aplicado devido à falha ou indisponibilidade da localização.")
+
+
+            # --- PLOTAGEM ---
+            if not df_filtrada.empty:
+                st.info(msg_filtro)
+
+                # Métricas
+                col1, col2 = st.columns(2)
+                col1.metric("Ônibus na região", len(df_filtrada))
+                tempo_recente = df_filtrada['datahora'].max().strftime('%H:%M:%S')
+                col2.metric("Último sinal recebido (BRT) às", tempo_recente)
+
+                # Centro do mapa
+                # Centraliza na localização do usuário/endereço se a localização foi bem-sucedida
+                location_ok = (localizacao_sucesso and usar_localizacao and 
+                               (location_source != 'Localização Automática (Browser)' or st.session_state.geo_result['status'] == 'success'))
             
-            if usar_localizacao and localizacao_sucesso and location_ok:
-                cols_show.append('distancia_km')
-                df_display = df_display.sort_values('distancia_km')
-
-            st.write("📋 Detalhes dos veículos encontrados:")
-            st.dataframe(df_display[cols_show], hide_index=True)
+                if location_ok:
+                    center_lat, center_lon, zoom_start = user_lat, user_lon, 14
+                else:
+                    # Centraliza na média dos ônibus encontrados
+                    center_lat = float(df_filtrada['latitude'].mean())
+                    center_lon = float(df_filtrada['longitude'].mean())
+                    zoom_start = 12
+
+                # Envia ao navegador só as colunas usadas no mapa/tooltip (o deck.gl renderiza via GPU)
+                cols_mapa = ['latitude', 'longitude', 'ordem', 'linha', 'velocidade']
+                tooltip_html = "<b>{ordem}</b><br/>Linha: {linha}<br/>Velocidade: {velocidade} km/h<br/>Sinal: {hora}"
+                if location_ok:
+                    cols_mapa.append('distancia_km')
+                    tooltip_html += "<br/>Distância: {distancia_km} km"
+                # Horário já formatado como texto numa única chamada vetorizada, em vez de serializar datetimes
+                df_mapa = df_filtrada[cols_mapa].assign(hora=df_filtrada['datahora'].dt.strftime('%H:%M:%S'))
+                # Volta a float64 arredondado só no frame pequeno do mapa, para o JSON não carregar dígitos espúrios do float32
+                df_mapa = df_mapa.assign(latitude=df_mapa['latitude'].astype('float64').round(6),
+                                         longitude=df_mapa['longitude'].astype('float64').round(6))
+                if location_ok:
+                    df_mapa = df_mapa.assign(distancia_km=df_mapa['distancia_km'].astype('float64').round(2))
+
+                st.subheader(f"Posição atual dos ônibus da linha {linha_desejada}")
+                # Adiciona o usuário no mapa (Se a localização foi obtida com sucesso)
+                render_bus_map(df_mapa, tooltip_html, center_lat, center_lon, zoom_start,
+                               (user_lat, user_lon) if location_ok else None, map_style)
+
+                # Mostra tabela simples
+                cols_show = ['ordem', 'datahora', 'velocidade', 'latitude', 'longitude']
+                df_display = df_filtrada
+
+                if usar_localizacao and localizacao_sucesso and location_ok:
+                    cols_show.append('distancia_km')
+                    # Seleção parcial (O(N)) dos mais próximos em vez de ordenar tudo
+                    df_display = df_display.nsmallest(TABELA_MAX_LINHAS, 'distancia_km')
+
+                st.write("📋 Detalhes dos veículos encontrados:")
+                # O rótulo da coluna é definido na renderização, sem copiar o DataFrame com rename
+                st.dataframe(
+                    df_display[cols_show],
+                    hide_index=True,
+                    column_config={
+                        'datahora': st.column_config.DatetimeColumn('Data/Hora (BRT)', format='HH:mm:ss'),
+                    },
+                )
 
+            else:
+                st.warning(f"Nenhum ônibus da linha {linha_desejada} encontrado dentro da área de busca ou dados indisponíveis.")
         else:
-            st.warning(f"Nenhum ônibus da linha {linha_desejada} encontrado dentro da área de busca ou dados indisponíveis.")
+            st.warning(f"Não há dados disponíveis para a linha {linha_desejada} no momento.")
     else:
-        st.warning(f"Não há dados disponíveis para a linha {linha_desejada} no momento.")
-else:
-    st.error("Erro ao obter dados da API. Tente novamente mais tarde.")
-
-# --- LÓGICA DE ATUALIZAÇÃO AUTOMÁTICA OTIMIZADA ---
-if auto_refresh:
-    countdown_placeholder = st.empty()
-
-    for i in range(25, 0, -1):
-        countdown_placeholder.markdown(
-            f"**Próxima atualização em {i} segundos...** (Atualização Automática Ativa)"
+        st.error("Erro ao obter dados da API. Tente novamente mais tarde.")
+
+    if cfg.auto_refresh:
+        # Contador regressivo só no navegador, sem nenhuma mensagem do servidor por segundo.
+        # O prazo é medido pelo relógio do navegador; o carimbo da execução (data-run) só muda o markup,
+        # para que o iframe seja recriado e o contador reinicie a cada execução do fragmento.
+        html(
+            f"""
+            <div id="countdown" data-run="{time.time_ns()}" style="font-family: sans-serif; font-weight: bold;"></div>
+            <script>
+                const fim = Date.now() + {REFRESH_INTERVAL_S} * 1000;
+                const el = document.getElementById('countdown');
+                function mostra() {{
+                    const restante = Math.max(Math.ceil((fim - Date.now()) / 1000), 0);
+                    el.textContent = `Próxima atualização em ${{restante}} segundos... (Atualização Automática Ativa)`;
+                }}
+                mostra();
+                setInterval(mostra, 1000);
+            </script>
+            """,
+            height=30,
         )
-        time.sleep(1) 
 
-    st.rerun()
 
+_refresh_map(cfg.user_lat, cfg.user_lon, cfg.raio_km, cfg.linha_desejada, cfg.usar_localizacao,
+             cfg.localizacao_sucesso, cfg.location_source, cfg.map_style)